@@ -123,6 +123,10 @@ class QuerySettings:
     cap_padding: int = DefaultVal(0)
     dynamic_query_maxlen: bool = DefaultVal(False)
     dynamic_querylen_multiples: int = DefaultVal(32)
+    # Tokenized-query LRU entries; 0 disables. Roughly 0.4 KB per ~50-char query (~40 MB at 100k)
+    query_cache_size: int = DefaultVal(0)
+    ids_dtype: str = DefaultVal("int32")
+    length_bucket_queries: bool = DefaultVal(False)
 
 
 @dataclass
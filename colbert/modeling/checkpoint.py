@@ -106,6 +106,17 @@ class Checkpoint(ColBERT):
                 bsize=bsize,
                 full_length_search=full_length_search,
             )
+
+            if self.colbert_config.length_bucket_queries:
+                # Batches come back sorted by length and trimmed to their own widths
+                batches, reverse_indices = batches
+                batches = [
+                    self.query(input_ids, attention_mask, to_cpu=to_cpu)
+                    for input_ids, attention_mask in batches
+                ]
+                Q = _stack_3D_tensors(batches)
+                return Q[reverse_indices.to(Q.device)]
+
             batches = [
                 self.query(input_ids, attention_mask, to_cpu=to_cpu)
                 for input_ids, attention_mask in batches
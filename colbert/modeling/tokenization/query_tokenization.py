@@ -1,8 +1,14 @@
 import torch
+import math
+import itertools
+import threading
+import numpy as np
+
+from collections import OrderedDict
 
 from colbert.modeling.hf_colbert import class_factory
 from colbert.infra import ColBERTConfig
-from colbert.modeling.tokenization.utils import _split_into_batches
+from colbert.modeling.tokenization.utils import _split_into_batches, _sort_by_length, _batch_widths, _pack_sequences
 from colbert.utils.utils import batch
 from colbert.parameters import DEVICE
 
@@ -13,6 +19,9 @@ class QueryTokenizer():
         self.tok = HF_ColBERT.raw_tokenizer_from_pretrained(config.checkpoint)
         self.verbose = verbose
 
+        # tokenize() reads tokens off the Rust encodings, which only fast tokenizers expose
+        assert self.tok.is_fast, "QueryTokenizer requires a fast (Rust-backed) tokenizer"
+
         self.config = config
         self.query_maxlen = config.query_maxlen
         self.background_maxlen = 512 - self.query_maxlen + 1  # FIXME: Make this configurable
@@ -22,20 +31,41 @@ class QueryTokenizer():
         self.sep_token, self.sep_token_id = self.tok.sep_token, self.tok.sep_token_id
         self.mask_token, self.mask_token_id = self.tok.mask_token, self.tok.mask_token_id
         self.pad_token,self.pad_token_id = self.tok.pad_token,self.tok.pad_token_id
-        self.used = False
+        # Vocabularies fit comfortably in int32, which halves the bytes moved per batch vs. int64
+        self.ids_dtype = getattr(torch, config.ids_dtype)
+        self._logged = False
+
+        # Queries used to be tokenized as '. ' + text; keep whatever that did to the first word
+        self._query_prefix = self._placeholder_prefix()
+
+        # Optional LRU of (text, max_length) -> int32 token ids, so repeated queries skip the tokenizer
+        self._cache = OrderedDict()
+        self._cache_size = config.query_cache_size
+        self._cache_lock = threading.Lock()
+
+        # Pinned host buffers for the H2D copy, by name ('ids', 'mask'), as (buffer, copy-done event)
+        self._staging = {}
+        self._staging_lock = threading.Lock()
 
     def tokenize(self, batch_text, add_special_tokens=False):
         assert type(batch_text) in [list, tuple], (type(batch_text))
 
-        tokens = [self.tok.tokenize(x, add_special_tokens=False) for x in batch_text]
+        # One batched encode in Rust; going through self.tok also resets padding left set by tensorize()
+        encodings = self.tok(list(batch_text), add_special_tokens=False).encodings
+        tokens = [e.tokens for e in encodings]
 
         if not add_special_tokens:
             return tokens
 
-        prefix, suffix = [self.cls_token, self.Q_marker_token], [self.sep_token]
-        tokens = [prefix + lst + suffix + [self.mask_token] * (self.query_maxlen - (len(lst)+3)) for lst in tokens]
+        padded = []
+        for lst in tokens:
+            row = [self.cls_token, self.Q_marker_token]
+            row.extend(lst)
+            row.append(self.sep_token)
+            row.extend(itertools.repeat(self.mask_token, self.query_maxlen - len(row)))
+            padded.append(row)
 
-        return tokens
+        return padded
 
     def encode(self, batch_text, add_special_tokens=False):
         assert type(batch_text) in [list, tuple], (type(batch_text))
@@ -45,16 +75,24 @@ class QueryTokenizer():
         if not add_special_tokens:
             return ids
 
-        prefix, suffix = [self.cls_token_id, self.Q_marker_token_id], [self.sep_token_id]
-        ids = [prefix + lst + suffix + [self.mask_token_id] * (self.query_maxlen - (len(lst)+3)) for lst in ids]
+        # [CLS] [Q] ... [SEP] [MASK]*, truncating the query body to fit query_maxlen
+        body = [lst[:self.query_maxlen - 3] for lst in ids]
+        lengths = np.fromiter(map(len, body), dtype=np.int64, count=len(body))
 
-        return ids
+        out = np.full((len(body), self.query_maxlen), self.mask_token_id, dtype=np.int32)
+        out[:, 0] = self.cls_token_id
+        out[:, 1] = self.Q_marker_token_id
 
-    def tensorize(self, batch_text, bsize=None, context=None, full_length_search=False):
-        assert type(batch_text) in [list, tuple], (type(batch_text))
+        # Scatter all bodies at once from their flat concatenation, each starting at column 2
+        rows = np.repeat(np.arange(len(body)), lengths)
+        cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + 2
+        out[rows, cols] = np.fromiter(itertools.chain.from_iterable(body), dtype=np.int32, count=lengths.sum())
+        out[np.arange(len(body)), 2 + lengths] = self.sep_token_id
 
-        # add placehold for the [Q] marker
-        batch_text = ['. ' + x for x in batch_text]
+        return torch.from_numpy(out).to(self.ids_dtype)
+
+    def tensorize(self, batch_text, bsize=None, context=None, full_length_search=False, return_packed=False):
+        assert type(batch_text) in [list, tuple], (type(batch_text))
 
         # Full length search is only available for single inference (for now)
         # Batched full length search requires far deeper changes to the code base
@@ -62,80 +100,220 @@ class QueryTokenizer():
 
         if full_length_search:
             # Tokenize each string in the batch
-            un_truncated_ids = self.tok(batch_text, add_special_tokens=False).to(self.config.rank)['input_ids']
-            # Get the longest length in the batch
-            max_length_in_batch = max(len(x) for x in un_truncated_ids)
+            un_truncated_ids = self.tok([self._query_prefix + x for x in batch_text], add_special_tokens=False, return_token_type_ids=False,
+                                        return_attention_mask=False).to(self.config.rank)['input_ids']
+            # Get the longest length in the batch, counting the [Q] marker
+            max_length_in_batch = max(len(x) for x in un_truncated_ids) + 1
             # Set the max length
             max_length = self.max_len(max_length_in_batch)
         else:
             # Max length is the default max length from the config
             max_length = self.query_maxlen
 
-        obj = self.tok(batch_text, padding='max_length', truncation=True,
-                       return_tensors='pt', max_length=max_length).to(self.config.rank)
-
-        ids, mask = obj['input_ids'], obj['attention_mask']
+        # Everything up to the final transfer stays on the CPU, padded only as wide as we keep
+        # Leave one slot for the [Q] marker, which is spliced in after [CLS] below
+        rows = self._encode_cached(batch_text, max_length - 1)
+        lengths = torch.tensor([len(row) for row in rows], dtype=torch.int64)
 
         # postprocess for the [Q] marker and the [MASK] augmentation
         # Log original size
-        ids[:, 1] = self.Q_marker_token_id
-        unpadded_sizes = (ids != self.pad_token_id).sum(dim=1)
+        unpadded_sizes = lengths + 1
         # Log original sizes
         original_sizes = unpadded_sizes.clone()
-        if self.config.query_pad_tok == "mask":
-            ids[ids == self.pad_token_id] = self.mask_token_id
 
-        # Shorten ids and mask if necessary
+        # Shorten ids and mask if necessary: the batch never needs to be wider than its longest query + cap_padding
         if self.config.cap_padding > 0:
-            for i in range(ids.size(0)):
-                unpadded_size = unpadded_sizes[i].item()
-                # Add 8 to the query size itself, per query
-                max_allowed_length = unpadded_size + self.config.cap_padding
-                if ids.size(1) > max_allowed_length:
-                    ids[i, max_allowed_length:] = self.pad_token_id
-                    mask[i, max_allowed_length:] = 0
-            # Trim the batch to the maximum allowed length across all queries
-            max_length = max(unpadded_size + self.config.cap_padding for unpadded_size in unpadded_sizes)
-            max_length = min(max_length, ids.size(1))
-            ids = ids[:, :max_length]
-            mask = mask[:, :max_length]
+            max_length = (unpadded_sizes.max() + self.config.cap_padding).clamp_max(max_length).item()
+
+        positions = torch.arange(max_length).unsqueeze(0)
+        mask = (positions < unpadded_sizes.unsqueeze(1)).to(torch.int64)
+
+        # Start from the padding token itself, so the [MASK] augmentation needs no separate pass over ids
+        pad_id = self.mask_token_id if self.config.query_pad_tok == "mask" else self.pad_token_id
+
+        # Scatter each [CLS] ... [SEP] row into place, shifted right by one past [CLS] to make room for [Q]
+        ids = torch.full((len(rows), max_length), pad_id, dtype=self.ids_dtype)
+        ids[:, 1] = self.Q_marker_token_id
+
+        flat = torch.from_numpy(np.concatenate(rows)).to(self.ids_dtype)
+        row_idx = torch.repeat_interleave(torch.arange(len(rows)), lengths)
+        cols = torch.arange(flat.size(0)) - (lengths.cumsum(0) - lengths)[row_idx]
+        ids[row_idx, cols + (cols > 0).to(torch.int64)] = flat
+
+        if self.config.cap_padding > 0:
+            # Add 8 to the query size itself, per query, and pad out everything past that in one shot
+            overflow = positions >= (unpadded_sizes + self.config.cap_padding).unsqueeze(1)
+            ids.masked_fill_(overflow, self.pad_token_id)
+            mask.masked_fill_(overflow, 0)
         # Note: This implementation already adds 8 (or the value of cap_padding) to each query individually
 
 
         if context is not None:
             assert len(context) == len(batch_text), (len(context), len(batch_text))
 
-            obj_2 = self.tok(context, padding='longest', truncation=True,
-                            return_tensors='pt', max_length=self.background_maxlen).to(self.config.rank)
+            # No special tokens: the leading [CLS] would just be sliced off again. Only the trailing [SEP] is
+            # kept, and it is written in below (one slot past each context, hence one token less here)
+            obj_2 = self.tok(context, add_special_tokens=False, padding='longest', truncation=True,
+                            return_tensors='pt', max_length=self.background_maxlen - 2,
+                            return_token_type_ids=False, return_attention_mask=True)
+
+            ids_2 = torch.nn.functional.pad(obj_2['input_ids'].to(self.ids_dtype), (0, 1), value=self.pad_token_id)
+            mask_2 = torch.nn.functional.pad(obj_2['attention_mask'], (0, 1), value=0)
+
+            batch_idx, context_sizes = torch.arange(ids_2.size(0)), obj_2['attention_mask'].sum(dim=1)
+            ids_2[batch_idx, context_sizes] = self.sep_token_id
+            mask_2[batch_idx, context_sizes] = 1
+
+        # The pinned staging buffers are shared by every tensorize() call (server.py is threaded), so hold
+        # them from the first write into them until the transfer out of them has been queued
+        with self._staging_lock:
+            if context is not None:
+                # Concatenate straight into the pinned staging buffers, which _to_device() then ships as-is
+                shape = (ids.size(0), ids.size(1) + ids_2.size(1))
+                ids = torch.cat((ids, ids_2), dim=-1, out=self._staged('ids', shape, ids.dtype))
+                mask = torch.cat((mask, mask_2), dim=-1, out=self._staged('mask', shape, mask.dtype))
+
+            if self.config.attend_to_mask_tokens:
+                mask[ids == self.mask_token_id] = 1
+                # Fails if [PAD] survived (e.g., query_pad_tok='pad'); ids/mask are still on the CPU, so no device sync
+                assert mask.all(), mask
+
+            if bsize and self.config.length_bucket_queries:
+                # Group similar lengths so each batch only carries its own longest query's padding. Sorting and
+                # sizing the batches on the host leaves nothing but slicing to do once ids are on the device.
+                ids, mask, reverse_indices = _sort_by_length(ids, mask, bsize)
+                widths = _batch_widths(ids, bsize, self.pad_token_id)
+
+            if return_packed:
+                # Pack (per batch, if batching) while ids/mask are still on the host, so max_seqlen costs no sync
+                chunks = _split_into_batches(ids, mask, bsize) if bsize else [(ids, mask)]
+                packs = [self._pack_to_device(_pack_sequences(ids, mask, self.pad_token_id)) for ids, mask in chunks]
+
+            ids, mask = self._to_device(ids, 'ids'), self._to_device(mask, 'mask')
+
+        if bsize:
+            batches = _split_into_batches(ids, mask, bsize)
 
-            ids_2, mask_2 = obj_2['input_ids'][:, 1:], obj_2['attention_mask'][:, 1:]  # Skip the first [SEP]
+            if self.config.length_bucket_queries:
+                batches = [(ids[:, :width], mask[:, :width]) for (ids, mask), width in zip(batches, widths)]
 
-            ids = torch.cat((ids, ids_2), dim=-1)
-            mask = torch.cat((mask, mask_2), dim=-1)
+            if return_packed:
+                batches = [(ids, mask, pack) for (ids, mask), pack in zip(batches, packs)]
 
-        if self.config.attend_to_mask_tokens:
-            mask[ids == self.mask_token_id] = 1
-            assert mask.sum().item() == mask.size(0) * mask.size(1), mask
+            if self.config.length_bucket_queries:
+                return batches, reverse_indices
 
-        if bsize:
-            batches = _split_into_batches(ids, mask, bsize)
             return batches
         
-        self.used = True
-        if self.used is False:
-            self.used = True
-
-            firstbg = (context is None) or context[0]
-            if self.verbose > 1:
-                print()
-                print("#> QueryTokenizer.tensorize(batch_text[0], batch_background[0], bsize) ==")
-                print(f"#> Input: {batch_text[0]}, \t\t {firstbg}, \t\t {bsize}")
-                print(f"#> Output IDs: {ids[0].size()}, {ids[0]}")
-                print(f"#> Output Mask: {mask[0].size()}, {mask[0]}")
-                print()
+        if self.verbose > 1 and not self._logged:
+            self._logged = True
+            self._log_first_batch(batch_text, context, bsize, ids, mask)
+
+        if return_packed:
+            return ids, mask, packs[0]
 
         return ids, mask
 
+    def _log_first_batch(self, batch_text, context, bsize, ids, mask):
+        firstbg = (context is None) or context[0]
+
+        print()
+        print("#> QueryTokenizer.tensorize(batch_text[0], batch_background[0], bsize) ==")
+        print(f"#> Input: {batch_text[0]}, \t\t {firstbg}, \t\t {bsize}")
+        print(f"#> Output IDs: {ids[0].size()}, {ids[0].tolist()}")
+        print(f"#> Output Mask: {mask[0].size()}, {mask[0].tolist()}")
+        print()
+
+    def _placeholder_prefix(self):
+        # WordPiece tokenizes text the same at the start as after '. ', but byte-level BPE (e.g., RoBERTa) only
+        # encodes 'Ġword' after a space, and SentencePiece turns the bare trailing space into its own token.
+        # A single ' ' reproduces both, so it is used unless the raw text already tokenizes identically.
+        def encode(text):
+            return self.tok(text, add_special_tokens=False, return_token_type_ids=False,
+                            return_attention_mask=False)['input_ids']
+
+        skip = len(encode('.'))
+        probes = ['query', '']
+
+        if all(encode(probe) == encode('. ' + probe)[skip:] for probe in probes):
+            return ''
+
+        return ' '
+
+    def _encode_cached(self, batch_text, max_length):
+        if self._cache_size <= 0:
+            return self._encode(batch_text, max_length)
+
+        # Lookup and recency update must be atomic: another tensorize() thread may evict in between
+        rows = []
+        with self._cache_lock:
+            for x in batch_text:
+                row = self._cache.get((x, max_length))
+                if row is not None:
+                    self._cache.move_to_end((x, max_length))
+                rows.append(row)
+
+        misses = [idx for idx, row in enumerate(rows) if row is None]
+
+        if misses:
+            encoded = self._encode([batch_text[idx] for idx in misses], max_length)
+
+            with self._cache_lock:
+                for idx, row in zip(misses, encoded):
+                    rows[idx] = row
+                    self._cache[(batch_text[idx], max_length)] = row
+
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+
+        return rows
+
+    def _encode(self, batch_text, max_length):
+        # Only input_ids are used; the mask is rebuilt from the row lengths in tensorize()
+        obj = self.tok([self._query_prefix + x for x in batch_text], truncation=True, max_length=max_length,
+                       return_token_type_ids=False, return_attention_mask=False)
+
+        return [np.asarray(row, dtype=np.int32) for row in obj['input_ids']]
+
+    def _staged(self, name, shape, dtype):
+        # Callers hold self._staging_lock
+        if not torch.cuda.is_available():
+            return None
+
+        # Pinned buffers are reused across calls (grown as needed), so the H2D copy can overlap with
+        # whatever runs next without allocating page-locked memory every time
+        numel = math.prod(shape)
+        staging, copied = self._staging.get(name, (None, None))
+
+        if staging is None or staging.dtype != dtype or staging.numel() < numel:
+            staging, copied = torch.empty(numel, dtype=dtype, pin_memory=True), torch.cuda.Event()
+            self._staging[name] = (staging, copied)
+        else:
+            # The previous call's copy out of this buffer may still be in flight
+            copied.synchronize()
+
+        return staging[:numel].view(shape)
+
+    def _to_device(self, tensor, name):
+        if not torch.cuda.is_available():
+            return tensor.to(self.config.rank)
+
+        staging, _ = self._staging.get(name, (None, None))
+
+        if staging is None or tensor.data_ptr() != staging.data_ptr():
+            staged = self._staged(name, tensor.shape, tensor.dtype)
+            staged.copy_(tensor)
+            tensor = staged
+
+        tensor = tensor.to(self.config.rank, non_blocking=True)
+        self._staging[name][1].record(torch.cuda.current_stream(tensor.device))
+
+        return tensor
+
+    def _pack_to_device(self, pack):
+        # max_seqlen stays a Python int; only the tensors move
+        return tuple(t.to(self.config.rank) if torch.is_tensor(t) else t for t in pack)
+
     # Ensure that query_maxlen <= length <= 500 tokens
     def max_len(self, length):
         return min(500, max(self.query_maxlen, length))
@@ -47,6 +47,36 @@ def _sort_by_length(ids, mask, bsize):
     return ids[indices], mask[indices], reverse_indices
 
 
+def _batch_widths(ids, bsize, pad_token_id):
+    # Up to the last non-pad token, not the count of them: with a context, [PAD] can sit mid-sequence
+    positions = torch.arange(1, ids.size(1) + 1, device=ids.device)
+    ends = ((ids != pad_token_id) * positions).max(-1).values
+
+    return [ends[offset:offset+bsize].max().item() for offset in range(0, ids.size(0), bsize)]
+
+
+def _pack_sequences(ids, mask, pad_token_id):
+    """
+    Flattens a padded (B, L) batch into the padding-free layout used by variable-length attention
+    kernels (e.g., flash_attn_varlen_func): all kept tokens back to back, their attention mask,
+    cumulative sequence boundaries, and each token's position within its own padded row.
+
+    Only [PAD] that is also masked out is dropped; [MASK] augmentation tokens are kept (they are
+    embedded even when not attended to), and the per-token mask says which ones to attend to.
+    Meant to run on the host: max_seqlen is read off the CPU tensors without a device sync.
+    """
+
+    keep = (ids != pad_token_id) | mask.bool()
+    lengths = keep.sum(dim=-1)
+
+    input_ids, attention_mask = ids[keep], mask[keep]
+    cu_seqlens = torch.nn.functional.pad(lengths.cumsum(0), (1, 0)).to(torch.int32)
+    position_ids = torch.arange(ids.size(1), device=ids.device).expand_as(ids)[keep]
+    max_seqlen = lengths.max().item()
+
+    return input_ids, attention_mask, cu_seqlens, position_ids, max_seqlen
+
+
 def _split_into_batches(ids, mask, bsize):
     batches = []
     for offset in range(0, ids.size(0), bsize):
@@ -0,0 +1,44 @@
+import torch
+
+from colbert.modeling.tokenization.utils import _pack_sequences
+
+PAD, MASK = 0, 103
+
+
+def main():
+    # [CLS] [Q] tokens [SEP] [MASK]* rows, one capped with [PAD], one followed by a padded context
+    ids = torch.tensor([
+        [101, 1, 7, 8, 102, MASK, MASK, PAD, PAD],
+        [101, 1, 9, 102, MASK, PAD, 5, 102, PAD],
+        [101, 1, 4, 5, 6, 102, MASK, MASK, MASK],
+    ])
+    mask = torch.tensor([
+        [1, 1, 1, 1, 1, 0, 0, 0, 0],
+        [1, 1, 1, 1, 0, 0, 1, 1, 0],
+        [1, 1, 1, 1, 1, 1, 1, 1, 1],
+    ])
+
+    input_ids, attention_mask, cu_seqlens, position_ids, max_seqlen = _pack_sequences(ids, mask, PAD)
+
+    # Every token but the masked-out [PAD] survives, [MASK] included, each with its padded-batch mask
+    keep = ids != PAD
+    assert torch.equal(input_ids, ids[keep]), input_ids
+    assert torch.equal(attention_mask, mask[keep]), attention_mask
+
+    lengths = keep.sum(-1)
+    assert cu_seqlens.dtype == torch.int32
+    assert cu_seqlens.tolist() == [0] + lengths.cumsum(0).tolist(), cu_seqlens
+    assert max_seqlen == lengths.max().item() == 9, max_seqlen
+
+    # Positions match the padded batch's, so the context keeps its offset past the mid-row [PAD]
+    for row, (start, end) in enumerate(zip(cu_seqlens[:-1].tolist(), cu_seqlens[1:].tolist())):
+        assert position_ids[start:end].tolist() == keep[row].nonzero().squeeze(-1).tolist(), (row, position_ids)
+        assert torch.equal(input_ids[start:end], ids[row, position_ids[start:end]])
+
+    print("Packed layout matches the padded batch")
+
+
+if __name__ == "__main__":
+    main()
+
+    print("Exiting test")
@@ -5,37 +5,57 @@ from colbert.utils.utils import NullContextManager
 
 
 class MixedPrecisionManager():
-    def __init__(self, activated: bool):
+    def __init__(self, activated: bool, bf16: bool = False):
         self.activated = activated
-        if self.activated:
+
+        # bf16 runs at fp16 speed on Ampere+ but keeps fp32's range, so it needs no loss scaling.
+        # Older GPUs only emulate it (which is_bf16_supported() counts), so check for native support.
+        use_bf16 = bf16 and torch.cuda.is_available() and torch.cuda.get_device_capability() >= (8, 0)
+        self.dtype = torch.bfloat16 if use_bf16 else torch.float16
+
+        self.scaler = None
+        if self.activated and self.dtype == torch.float16:
             # CHANGE: GradScaler is now imported from torch.amp
             self.scaler = torch.GradScaler()
 
+        self._optimizer, self._params = None, None
+
     def context(self):
         # CHANGE: Use torch.amp.autocast and specify the device_type
         if self.activated:
-            return torch.autocast(device_type='cuda')
+            return torch.autocast(device_type='cuda', dtype=self.dtype)
         else:
             return contextlib.nullcontext()
 
     def backward(self, loss):
-        if self.activated:
+        if self.scaler is not None:
             self.scaler.scale(loss).backward()
         else:
             loss.backward()
 
     def step(self, colbert, optimizer, scheduler=None):
-        if self.activated:
+        params = self._parameters(colbert, optimizer)
+
+        if self.scaler is not None:
             self.scaler.unscale_(optimizer)
             if scheduler is not None:
-                torch.nn.utils.clip_grad_norm_(colbert.parameters(), 2.0, error_if_nonfinite=False)
+                torch.nn.utils.clip_grad_norm_(params, 2.0, error_if_nonfinite=False)
 
             self.scaler.step(optimizer)
             self.scaler.update()
         else:
             if scheduler is not None:
-                torch.nn.utils.clip_grad_norm_(colbert.parameters(), 2.0)
+                torch.nn.utils.clip_grad_norm_(params, 2.0)
             optimizer.step()
         
         if scheduler is not None:
             scheduler.step()
+
+    def _parameters(self, colbert, optimizer):
+        # Walk the module tree once per optimizer instead of on every step. All parameters are kept,
+        # including frozen ones (warmup_bert toggles requires_grad); clipping skips those without grads.
+        if optimizer is not self._optimizer:
+            self._optimizer = optimizer
+            self._params = list(colbert.parameters())
+
+        return self._params